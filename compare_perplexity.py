@@ -3,66 +3,89 @@
 Compare different t-SNE perplexity values to see clustering differences.
 """
 
-import chromadb
 import numpy as np
-from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+import os
+import sys
 import time
+from visualize_tsne import (categorize_fables, extract_embeddings_from_chromadb, fit_tsne,
+                            reduce_embeddings, resolve_tsne_backend, tsne_cache_key)
 
-def extract_embeddings_from_chromadb(db_path: str = "./chroma_db") -> Tuple[np.ndarray, List[dict]]:
-    """Extract all embeddings and metadata from ChromaDB."""
-    print("Connecting to ChromaDB...")
-    client = chromadb.PersistentClient(path=db_path)
-    collection = client.get_collection("aesop_fables")
-    
-    print("Extracting embeddings...")
-    results = collection.get(include=['embeddings', 'metadatas', 'documents'])
-    
-    embeddings = np.array(results['embeddings'])
-    metadatas = results['metadatas']
-    
-    print(f"Extracted {len(embeddings)} embeddings of dimension {embeddings.shape[1]}")
-    
-    return embeddings, metadatas
+try:
+    from openTSNE.affinity import PerplexityBasedNN
+    from openTSNE.nearest_neighbors import PrecomputedNeighbors
+except ImportError:
+    PerplexityBasedNN = PrecomputedNeighbors = None
 
-def categorize_fables(metadatas: List[dict]) -> List[str]:
-    """Simple categorization of fables based on title keywords."""
-    categories = []
-    
-    for metadata in metadatas:
-        title = metadata['title'].lower()
+PERPLEXITY_VALUES = [5, 15, 30, 60]
+TSNE_CACHE_FILE = "tsne_cache.npz"
+
+def compute_shared_neighbors(embeddings: np.ndarray, perplexity_values: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Find nearest neighbors once, with enough neighbors (3 * perplexity) for the largest perplexity."""
+    k = min(3 * max(perplexity_values), len(embeddings) - 1)
+    print(f"Finding {k} nearest neighbors for all perplexity values...")
+    distances, indices = NearestNeighbors(n_neighbors=k, n_jobs=-1).fit(embeddings).kneighbors()
+    return indices, distances
+
+def shared_affinities(neighbors: Tuple[np.ndarray, np.ndarray], perplexity: int):
+    """Build openTSNE affinities from the shared kNN graph, truncated to the 3 * perplexity neighbors this run needs."""
+    indices, distances = neighbors
+    k = min(3 * perplexity, indices.shape[1])
+    knn_index = PrecomputedNeighbors(np.ascontiguousarray(indices[:, :k]),
+                                     np.ascontiguousarray(distances[:, :k]))
+    return PerplexityBasedNN(perplexity=perplexity, knn_index=knn_index, n_jobs=-1)
+
+def compute_tsne_embeddings(embeddings: np.ndarray, perplexity_values: List[int] = PERPLEXITY_VALUES,
+                            cache_file: str = TSNE_CACHE_FILE) -> Dict[int, np.ndarray]:
+    """Run t-SNE once per perplexity value, reusing cached results from disk when available."""
+    backend = resolve_tsne_backend()
+    # The cache is only valid for the same embedding values, backend and settings
+    digest = tsne_cache_key(embeddings, backend, "shared-knn-pca", *perplexity_values)
+    if os.path.exists(cache_file):
+        # Close the archive before returning, or before np.savez overwrites it on a mismatch
+        with np.load(cache_file) as cached:
+            if 'digest' in cached and str(cached['digest']) == digest:
+                print(f"Loaded cached t-SNE results from {cache_file}")
+                return {p: cached[str(p)] for p in perplexity_values}
+    
+    # Reduce once: the shared kNN graph and every run work on the same PCA components
+    embeddings = reduce_embeddings(embeddings)
+    
+    # Only openTSNE can reuse a precomputed kNN graph here: sklearn accepts one via
+    # metric='precomputed', but that rules out init='pca', so it builds its own per run
+    neighbors = None
+    if backend == "opentsne" and PerplexityBasedNN is not None:
+        neighbors = compute_shared_neighbors(embeddings, perplexity_values)
+    
+    tsne_results = {}
+    for i, perplexity in enumerate(perplexity_values):
+        print(f"\n[{i+1}/{len(perplexity_values)}] Running t-SNE with perplexity={perplexity}...")
+        start_time = time.time()
         
-        if any(animal in title for animal in ['fox', 'wolf', 'lion', 'bear', 'tiger']):
-            category = 'Predators'
-        elif any(animal in title for animal in ['hare', 'rabbit', 'mouse', 'deer', 'lamb']):
-            category = 'Prey Animals'
-        elif any(animal in title for animal in ['dog', 'cat', 'horse', 'ass', 'donkey']):
-            category = 'Domestic Animals'
-        elif any(bird in title for bird in ['crow', 'eagle', 'owl', 'peacock', 'swan', 'nightingale']):
-            category = 'Birds'
-        elif any(word in title for word in ['man', 'woman', 'boy', 'girl', 'farmer', 'king', 'merchant']):
-            category = 'Human Stories'
-        elif any(word in title for word in ['sun', 'wind', 'tree', 'mountain', 'river']):
-            category = 'Nature'
-        else:
-            category = 'Other'
+        affinities = shared_affinities(neighbors, perplexity) if neighbors is not None else None
+        tsne_results[perplexity] = fit_tsne(embeddings, perplexity, backend, affinities, verbose=True)
         
-        categories.append(category)
+        elapsed_time = time.time() - start_time
+        print(f"Completed in {elapsed_time:.1f} seconds")
+    
+    np.savez(cache_file, digest=digest, **{str(p): v for p, v in tsne_results.items()})
+    print(f"Cached t-SNE results to {cache_file}")
     
-    return categories
+    return tsne_results
 
-def compare_perplexity_values(embeddings: np.ndarray, metadatas: List[dict], 
-                            perplexity_values: List[int] = [5, 15, 30, 60]):
-    """Create t-SNE visualizations with different perplexity values."""
+def compare_perplexity_values(tsne_results: Dict[int, np.ndarray], metadatas: List[dict]):
+    """Create a side-by-side comparison of precomputed t-SNE results for each perplexity value."""
+    perplexity_values = list(tsne_results)
     
     # Prepare metadata
-    categories = categorize_fables(metadatas)
-    titles = [m['title'] for m in metadatas]
-    word_counts = [m['word_count'] for m in metadatas]
+    categories = np.asarray(categorize_fables(metadatas))
+    titles = np.asarray([m['title'] for m in metadatas], dtype=object)
+    word_counts = np.asarray([m['word_count'] for m in metadatas])
     
     # Create subplots
     fig = make_subplots(
@@ -77,16 +100,14 @@ def compare_perplexity_values(embeddings: np.ndarray, metadatas: List[dict],
     colors = px.colors.qualitative.Set1[:len(unique_categories)]
     color_map = dict(zip(unique_categories, colors))
     
+    # Category membership and hover data don't depend on perplexity, so slice them once
+    # per category and reuse the same arrays in all four subplots
+    customdata = np.column_stack([titles, word_counts.astype(object)])
+    category_masks = {category: categories == category for category in unique_categories}
+    category_customdata = {category: customdata[mask] for category, mask in category_masks.items()}
+    
     for i, perplexity in enumerate(perplexity_values):
-        print(f"\n[{i+1}/{len(perplexity_values)}] Running t-SNE with perplexity={perplexity}...")
-        start_time = time.time()
-        
-        # Run t-SNE with verbose output
-        tsne = TSNE(n_components=2, random_state=42, perplexity=perplexity, n_iter=1000, verbose=1)
-        embeddings_2d = tsne.fit_transform(embeddings)
-        
-        elapsed_time = time.time() - start_time
-        print(f"Completed in {elapsed_time:.1f} seconds")
+        embeddings_2d = tsne_results[perplexity]
         
         # Calculate subplot position
         row = (i // 2) + 1
@@ -94,14 +115,13 @@ def compare_perplexity_values(embeddings: np.ndarray, metadatas: List[dict],
         
         # Add traces for each category
         for category in unique_categories:
-            mask = [c == category for c in categories]
+            mask = category_masks[category]
             x_vals = embeddings_2d[mask, 0]
             y_vals = embeddings_2d[mask, 1]
-            category_titles = [titles[j] for j, m in enumerate(mask) if m]
-            category_word_counts = [word_counts[j] for j, m in enumerate(mask) if m]
+            category_data = category_customdata[category]
             
             fig.add_trace(
-                go.Scatter(
+                go.Scattergl(
                     x=x_vals,
                     y=y_vals,
                     mode='markers',
@@ -113,8 +133,8 @@ def compare_perplexity_values(embeddings: np.ndarray, metadatas: List[dict],
                         size=6,
                         opacity=0.7
                     ),
-                    text=category_titles,
-                    customdata=list(zip(category_titles, category_word_counts)),
+                    text=category_data[:, 0],
+                    customdata=category_data,
                     hovertemplate='<b>%{customdata[0]}</b><br>' +
                                   f'Category: {category}<br>' +
                                   'Word Count: %{customdata[1]}<br>' +
@@ -138,29 +158,19 @@ def compare_perplexity_values(embeddings: np.ndarray, metadatas: List[dict],
     
     # Save the plot
     output_file = "fables_tsne_perplexity_comparison.html"
-    fig.write_html(output_file)
+    fig.write_html(output_file, include_plotlyjs='cdn', validate=False)
     print(f"Saved comparison visualization to {output_file}")
     
     return fig
 
-def create_individual_plots(embeddings: np.ndarray, metadatas: List[dict]):
-    """Create individual plots for each perplexity value."""
+def create_individual_plots(tsne_results: Dict[int, np.ndarray], metadatas: List[dict]):
+    """Create individual plots for each precomputed perplexity value."""
     categories = categorize_fables(metadatas)
     titles = [m['title'] for m in metadatas]
     word_counts = [m['word_count'] for m in metadatas]
     
-    perplexity_values = [5, 15, 30, 60]
-    
-    for i, perplexity in enumerate(perplexity_values):
-        print(f"\n[{i+1}/{len(perplexity_values)}] Creating individual plot for perplexity={perplexity}...")
-        start_time = time.time()
-        
-        # Run t-SNE
-        tsne = TSNE(n_components=2, random_state=42, perplexity=perplexity, n_iter=1000, verbose=1)
-        embeddings_2d = tsne.fit_transform(embeddings)
-        
-        elapsed_time = time.time() - start_time
-        print(f"t-SNE completed in {elapsed_time:.1f} seconds")
+    for i, (perplexity, embeddings_2d) in enumerate(tsne_results.items()):
+        print(f"\n[{i+1}/{len(tsne_results)}] Creating individual plot for perplexity={perplexity}...")
         
         # Create DataFrame
         df = pd.DataFrame({
@@ -179,30 +189,39 @@ def create_individual_plots(embeddings: np.ndarray, metadatas: List[dict]):
             color='category',
             title=f't-SNE Visualization (Perplexity = {perplexity})',
             labels={'x': 't-SNE Dimension 1', 'y': 't-SNE Dimension 2'},
-            hover_data=['title', 'word_count']
+            hover_data=['title', 'word_count'],
+            render_mode='webgl'
         )
         
         fig.update_layout(width=800, height=600)
         
         # Save individual plot
         output_file = f"fables_tsne_perplexity_{perplexity}.html"
-        fig.write_html(output_file)
+        fig.write_html(output_file, include_plotlyjs='cdn', validate=False)
         print(f"Saved to {output_file}")
 
 def main():
     print("Starting t-SNE perplexity comparison...")
-    print("This will take several minutes - each t-SNE run takes 1-3 minutes")
+    print("This will take several minutes - each t-SNE run takes 1-3 minutes (cached after the first run)")
     
     # Extract embeddings
     embeddings, metadatas = extract_embeddings_from_chromadb()
     print(f"Processing {len(embeddings)} fables with {embeddings.shape[1]}-dimensional embeddings")
     
-    print("\n=== PHASE 1: Creating comparison plot ===")
     start_total = time.time()
-    compare_perplexity_values(embeddings, metadatas)
+    print("\n=== PHASE 1: Running t-SNE ===")
+    tsne_results = compute_tsne_embeddings(embeddings)
+    
+    # Coordinates are cached by now, so figures can be rendered later without rerunning t-SNE
+    if '--no-html' in sys.argv[1:]:
+        print(f"\nSkipping HTML rendering; t-SNE results are cached in {TSNE_CACHE_FILE}")
+        return
+    
+    print("\n=== PHASE 2: Creating comparison plot ===")
+    compare_perplexity_values(tsne_results, metadatas)
     
-    print("\n=== PHASE 2: Creating individual plots ===")
-    create_individual_plots(embeddings, metadatas)
+    print("\n=== PHASE 3: Creating individual plots ===")
+    create_individual_plots(tsne_results, metadatas)
     
     total_time = time.time() - start_total
     print(f"\n✅ All done! Total time: {total_time/60:.1f} minutes")
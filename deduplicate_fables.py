@@ -1,27 +1,45 @@
 #!/usr/bin/env python3
 """
-Deduplicate fables by title and keep the best version of each story.
+Deduplicate fables by content and title and keep the best version of each story.
 """
 
 import json
 import re
-from typing import List, Dict
+import pandas as pd
+from typing import List, Dict, Tuple
 from collections import defaultdict
+from scrape_fables import clean_content, content_hash
 
-def normalize_title(title: str) -> str:
-    """Normalize title for comparison."""
+# Title normalization patterns, compiled once rather than on every call
+_PREFIX = re.compile(r'^(the|a|an)\s+')
+_SUFFIX = re.compile(r'\s+(fable|story|tale)$')
+_PUNCT = re.compile(r'[^\w\s]')
+_WS = re.compile(r'\s+')
+
+# Content quality markers, found in a single scan of each candidate
+_QUALITY_MARKERS = re.compile(
+    r'(?P<site>AesopFables\.com)'
+    r'|(?P<timing>Process took:)'
+    r'|(?P<copyright>Copyright)'
+    r'|(?P<lesson>(?i:moral:|lesson:|application:))'
+)
+
+def normalize_titles(titles: List[str]) -> pd.Series:
+    """Normalize titles for comparison, vectorized over the whole batch."""
+    titles = pd.Series(titles, dtype=object)
+    
     # Convert to lowercase
-    title = title.lower()
+    titles = titles.str.lower()
     
     # Remove common prefixes/suffixes
-    title = re.sub(r'^(the|a|an)\s+', '', title)
-    title = re.sub(r'\s+(fable|story|tale)$', '', title)
+    titles = titles.str.replace(_PREFIX, '', regex=True)
+    titles = titles.str.replace(_SUFFIX, '', regex=True)
     
     # Remove punctuation and extra spaces
-    title = re.sub(r'[^\w\s]', '', title)
-    title = re.sub(r'\s+', ' ', title).strip()
+    titles = titles.str.replace(_PUNCT, '', regex=True)
+    titles = titles.str.replace(_WS, ' ', regex=True).str.strip()
     
-    return title
+    return titles
 
 def choose_best_version(duplicates: List[Dict]) -> Dict:
     """Choose the best version from duplicates based on word count and content quality."""
@@ -43,16 +61,17 @@ def choose_best_version(duplicates: List[Dict]) -> Dict:
             word_score = 0.5
         
         # Score based on content quality (prefer versions without too much metadata)
+        markers = {match.lastgroup for match in _QUALITY_MARKERS.finditer(content)}
         content_score = 1.0
-        if 'AesopFables.com' in content:
+        if 'site' in markers:
             content_score -= 0.1
-        if 'Process took:' in content:
+        if 'timing' in markers:
             content_score -= 0.2
-        if 'Copyright' in content:
+        if 'copyright' in markers:
             content_score -= 0.1
         
         # Prefer versions with moral/lesson at the end
-        if any(word in content.lower() for word in ['moral:', 'lesson:', 'application:']):
+        if 'lesson' in markers:
             content_score += 0.2
         
         total_score = word_score * content_score
@@ -61,8 +80,29 @@ def choose_best_version(duplicates: List[Dict]) -> Dict:
     # Return the highest scored version
     return max(scored_versions, key=lambda x: x[0])[1]
 
+def drop_exact_duplicates(fables: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """Collapse fables with identical cleaned content, returning (kept, removed)."""
+    hash_groups = defaultdict(list)
+    for fable in fables:
+        # Older scrapes predate the stored hash and cleaned content
+        key = fable.get('content_hash') or content_hash(fable.get('cleaned_content') or clean_content(fable['content']))
+        hash_groups[key].append(fable)
+    
+    kept = []
+    removed = []
+    for group in hash_groups.values():
+        best_version = choose_best_version(group) if len(group) > 1 else group[0]
+        kept.append(best_version)
+        removed.extend(fable for fable in group if fable is not best_version)
+    
+    return kept, removed
+
+def get_url_suffix(url: str) -> str:
+    """Extract suffix from URL like /hca/a126."""
+    return url.split('?srch&')[-1] if '?srch&' in url else url
+
 def deduplicate_fables(input_file: str = "aesop_fables.json", output_file: str = "aesop_fables_deduplicated.json"):
-    """Remove duplicate fables based on title similarity."""
+    """Remove duplicate fables with identical content or similar titles."""
     print(f"Loading fables from {input_file}...")
     
     with open(input_file, 'r', encoding='utf-8') as f:
@@ -70,17 +110,21 @@ def deduplicate_fables(input_file: str = "aesop_fables.json", output_file: str =
     
     print(f"Original count: {len(fables)} fables")
     
-    # Group fables by normalized title
-    title_groups = defaultdict(list)
+    # Drop identical copies first, whatever their titles
+    fables, exact_duplicates = drop_exact_duplicates(fables)
+    print(f"Found {len(exact_duplicates)} exact content duplicates")
     
-    for fable in fables:
-        normalized_title = normalize_title(fable['title'])
-        title_groups[normalized_title].append(fable)
+    # Group fables by normalized title, keeping first-seen order
+    normalized_titles = normalize_titles([fable['title'] for fable in fables])
+    title_groups = {
+        normalized_title: [fables[i] for i in group.index]
+        for normalized_title, group in normalized_titles.groupby(normalized_titles, sort=False)
+    }
     
     # Keep only the best version of each title
     deduplicated_fables = []
-    duplicates_found = 0
-    removed_stories = []
+    duplicates_found = len(exact_duplicates)
+    removed_stories = [get_url_suffix(fable['url']) for fable in exact_duplicates]
     
     for normalized_title, group in title_groups.items():
         if len(group) > 1:
@@ -99,9 +143,7 @@ def deduplicate_fables(input_file: str = "aesop_fables.json", output_file: str =
             # Track removed stories
             for fable in group:
                 if fable != best_version:
-                    # Extract suffix from URL like /hca/a126
-                    url_suffix = fable['url'].split('?srch&')[-1] if '?srch&' in fable['url'] else fable['url']
-                    removed_stories.append(url_suffix)
+                    removed_stories.append(get_url_suffix(fable['url']))
             
             deduplicated_fables.append(best_version)
         else:
@@ -7,9 +7,9 @@ Loads scraped fables and creates embeddings using ChromaDB.
 import json
 import chromadb
 from chromadb.config import Settings
-import re
 from typing import List, Dict
 import os
+from scrape_fables import clean_content
 
 class FableEmbedder:
     def __init__(self, data_file: str = "aesop_fables_deduplicated.json", db_path: str = "./chroma_db"):
@@ -26,22 +26,6 @@ class FableEmbedder:
         print(f"Loaded {len(fables)} fables")
         return fables
     
-    def clean_content(self, content: str) -> str:
-        """Clean fable content for embedding."""
-        # Remove website header
-        content = re.sub(r'^AesopFables\.com.*?\n', '', content)
-        
-        # Remove footer/copyright
-        content = re.sub(r'Process took:.*?Copyright.*?$', '', content, flags=re.DOTALL)
-        content = re.sub(r'RETURN\s*Process took.*?$', '', content, flags=re.DOTALL)
-        content = re.sub(r'THE END\s*RETURN.*?$', '', content, flags=re.DOTALL)
-        
-        # Clean up extra whitespace
-        content = re.sub(r'\n\s*\n', '\n\n', content)
-        content = content.strip()
-        
-        return content
-    
     def setup_chromadb(self):
         """Initialize ChromaDB client and collection."""
         print(f"Setting up ChromaDB at {self.db_path}...")
@@ -67,44 +51,28 @@ class FableEmbedder:
         """Add fables to ChromaDB with embeddings."""
         print(f"Adding {len(fables)} fables to ChromaDB...")
         
-        # Prepare data for ChromaDB
-        documents = []
-        metadatas = []
-        ids = []
+        # Add to collection in batches (ChromaDB has batch size limits), building each batch as we go
+        batch_size = min(self.client.get_max_batch_size(), 500)
+        num_batches = (len(fables) - 1) // batch_size + 1
         
-        for i, fable in enumerate(fables):
-            # Clean content
-            cleaned_content = self.clean_content(fable['content'])
+        for i in range(0, len(fables), batch_size):
+            batch = fables[i:i + batch_size]
             
-            # Create document
-            documents.append(cleaned_content)
+            # Use content cleaned at scrape time, cleaning older scrapes on the fly
+            batch_docs = [fable.get('cleaned_content') or clean_content(fable['content']) for fable in batch]
             
-            # Create metadata
-            metadatas.append({
-                "title": fable['title'],
-                "original_title": fable['original_title'],
-                "url": fable['url'],
-                "word_count": fable['word_count'],
-                "cleaned_length": len(cleaned_content)
-            })
-            
-            # Create ID
-            ids.append(f"fable_{i:04d}")
-        
-        # Add to collection in batches (ChromaDB has batch size limits)
-        batch_size = 100
-        for i in range(0, len(documents), batch_size):
-            end_idx = min(i + batch_size, len(documents))
-            batch_docs = documents[i:end_idx]
-            batch_meta = metadatas[i:end_idx]
-            batch_ids = ids[i:end_idx]
-            
-            print(f"Processing batch {i//batch_size + 1}/{(len(documents)-1)//batch_size + 1}")
+            print(f"Processing batch {i//batch_size + 1}/{num_batches}")
             
             self.collection.add(
                 documents=batch_docs,
-                metadatas=batch_meta,
-                ids=batch_ids
+                metadatas=[{
+                    "title": fable['title'],
+                    "original_title": fable['original_title'],
+                    "url": fable['url'],
+                    "word_count": fable['word_count'],
+                    "cleaned_length": len(cleaned_content)
+                } for fable, cleaned_content in zip(batch, batch_docs)],
+                ids=[f"fable_{j:04d}" for j in range(i, i + len(batch))]
             )
         
         print("All fables embedded successfully!")
@@ -139,19 +107,18 @@ class FableEmbedder:
 def main():
     embedder = FableEmbedder()
     
-    # Load fables
-    fables = embedder.load_fables()
-    
     # Setup ChromaDB
     embedder.setup_chromadb()
     
     # Check if collection already has data
     existing_count = embedder.get_collection_info()
     
+    # Single decision point: embed into an empty collection, or recreate only when asked
+    recreate = False
     if existing_count > 0:
         print(f"Collection already contains {existing_count} documents.")
-        proceed = input("Do you want to recreate the collection? (y/n): ").lower().strip()
-        if proceed == 'y':
+        recreate = input("Do you want to recreate the collection? (y/n): ").lower().strip() == 'y'
+        if recreate:
             # Delete and recreate collection
             embedder.client.delete_collection("aesop_fables")
             embedder.collection = embedder.client.create_collection(
@@ -162,8 +129,9 @@ def main():
         else:
             print("Using existing collection")
     
-    # Only embed if collection is empty or was recreated
-    if existing_count == 0 or (existing_count > 0 and input("Do you want to recreate the collection? (y/n): ").lower().strip() == 'y'):
+    if existing_count == 0 or recreate:
+        # Load fables only when they are going to be embedded
+        fables = embedder.load_fables()
         embedder.embed_fables(fables)
     
     # Test the embeddings
@@ -4,12 +4,21 @@ Simple query interface for the Aesop fables ChromaDB collection.
 """
 
 import chromadb
+import os
 import sys
 
+def get_client():
+    """Connect to a running Chroma server if CHROMA_HOST is set, otherwise open the local database."""
+    host = os.environ.get("CHROMA_HOST")
+    if host:
+        # A long-lived server keeps the collection loaded, skipping the per-query cold start
+        return chromadb.HttpClient(host=host, port=int(os.environ.get("CHROMA_PORT", "8000")))
+    return chromadb.PersistentClient(path="./chroma_db")
+
 def query_fables(query: str, n_results: int = 5):
     """Search for fables similar to the query."""
     # Connect to ChromaDB
-    client = chromadb.PersistentClient(path="./chroma_db")
+    client = get_client()
     collection = client.get_collection("aesop_fables")
     
     # Perform search
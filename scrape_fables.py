@@ -5,21 +5,72 @@ Scrapes fables from aesopfables.com and saves them for embedding.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+import hashlib
 import json
+import threading
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urljoin
 from typing import List, Dict, Optional
 
+# Prefer the C-backed lxml parser when installed; html.parser is pure Python
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Content cleaning patterns, compiled once rather than on every call. The site header and
+# all footer variants are removed in a single pass. Each footer runs to the end of the text,
+# so the earliest footer marker wins: text the old sequential passes left before a later
+# marker (a stray RETURN, or THE END ahead of RETURN / Process took:) is removed as well.
+_BOILERPLATE = re.compile(
+    r'\AAesopFables\.com.*?\n'
+    r'|Process took:.*?Copyright.*'
+    r'|RETURN\s*Process took.*'
+    r'|THE END\s*RETURN.*',
+    re.DOTALL
+)
+_BLANK_LINES = re.compile(r'\n\s*\n')
+
+def clean_content(content: str) -> str:
+    """Clean fable content for embedding."""
+    # Remove website header and footer/copyright
+    content = _BOILERPLATE.sub('', content)
+    
+    # Clean up extra whitespace
+    content = _BLANK_LINES.sub('\n\n', content)
+    content = content.strip()
+    
+    return content
+
+def content_hash(content: str) -> str:
+    """Hash cleaned fable content, ignoring case and whitespace, to spot identical copies."""
+    return hashlib.sha256(' '.join(content.lower().split()).encode('utf-8')).hexdigest()
+
 class AesopScraper:
-    def __init__(self, base_url: str = "https://aesopfables.com"):
+    def __init__(self, base_url: str = "https://aesopfables.com", max_workers: int = 16):
         self.base_url = base_url
+        self.max_workers = max_workers
+        self.delay = 0.0
+        
+        # Shared rate limiter: every fable request claims the next free start time under the lock
+        self._rate_lock = threading.Lock()
+        self._next_request_time = 0.0
+        
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
         
+        # Keep enough pooled connections open for every worker thread
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
     def get_search_results(self, last: int = 822) -> List[Dict]:
         """Get search results page and extract fable links."""
         search_url = f"{self.base_url}/cgi/asearch.cgi?terms=a+&boolean=as+a+phrase&case=insensitive&first=1&last={last}"
@@ -28,7 +79,7 @@ class AesopScraper:
         response = self.session.get(search_url)
         response.raise_for_status()
         
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = BeautifulSoup(response.content, HTML_PARSER)
         
         # Find all links to individual fables
         fables = []
@@ -51,14 +102,24 @@ class AesopScraper:
         print(f"Found {len(fables)} fable links")
         return fables
     
+    def _wait_for_rate_limit(self):
+        """Block until this thread may start a request, spacing requests self.delay seconds apart."""
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_request_time)
+            self._next_request_time = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+    
     def scrape_fable(self, fable_info: Dict) -> Optional[Dict]:
         """Scrape individual fable content."""
         try:
+            self._wait_for_rate_limit()
             print(f"Scraping: {fable_info['title']}")
             response = self.session.get(fable_info['url'])
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.content, 'html.parser')
+            soup = BeautifulSoup(response.content, HTML_PARSER)
             
             # Extract the main content - usually in the body
             # Remove script and style elements
@@ -79,11 +140,15 @@ class AesopScraper:
             else:
                 extracted_title = fable_info['title']
             
+            cleaned_content = clean_content(text)
+            
             return {
                 'title': extracted_title,
                 'original_title': fable_info['title'],
                 'url': fable_info['url'],
                 'content': text,
+                'cleaned_content': cleaned_content,
+                'content_hash': content_hash(cleaned_content),
                 'word_count': len(text.split())
             }
             
@@ -92,24 +157,21 @@ class AesopScraper:
             return None
     
     def scrape_all_fables(self, max_fables: int = 822, delay: float = 1.0) -> List[Dict]:
-        """Scrape all fables with rate limiting."""
+        """Scrape all fables concurrently, starting at most one request every delay seconds."""
         # First get the search results
         fable_links = self.get_search_results(max_fables)
         
-        scraped_fables = []
-        
-        for i, fable_info in enumerate(fable_links, 1):
-            print(f"Progress: {i}/{len(fable_links)}")
-            
-            fable_data = self.scrape_fable(fable_info)
-            if fable_data:
-                scraped_fables.append(fable_data)
+        # Submit everything up front; the shared rate limiter paces the workers
+        self.delay = delay
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.scrape_fable, fable_info) for fable_info in fable_links]
             
-            # Rate limiting
-            if i < len(fable_links):
-                time.sleep(delay)
+            for i, _ in enumerate(as_completed(futures), 1):
+                print(f"Progress: {i}/{len(fable_links)}")
         
-        return scraped_fables
+        # Collect in search result order, not completion order
+        scraped_fables = [future.result() for future in futures]
+        return [fable_data for fable_data in scraped_fables if fable_data]
     
     def save_fables(self, fables: List[Dict], filename: str = "aesop_fables.json"):
         """Save scraped fables to JSON file."""
@@ -121,7 +183,7 @@ def main():
     scraper = AesopScraper()
     
     print("Scraping all 822 fables...")
-    all_fables = scraper.scrape_all_fables(max_fables=822, delay=0)
+    all_fables = scraper.scrape_all_fables(max_fables=822, delay=0.25)
     scraper.save_fables(all_fables, "aesop_fables.json")
     
     if all_fables:
@@ -5,188 +5,293 @@ Create t-SNE visualization of Aesop fables embeddings.
 
 import chromadb
 import numpy as np
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
-import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
+import hashlib
 import re
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from pathlib import Path
 from typing import List, Tuple
 
-def extract_embeddings_from_chromadb(db_path: str = "./chroma_db") -> Tuple[np.ndarray, List[dict]]:
+TSNE_CACHE_DIR = Path(".tsne_cache")
+PCA_COMPONENTS = 50
+# Optimisation iterations per backend. PCA initialisation lets sklearn converge within 750
+# (250 of them early exaggeration); openTSNE counts its 250 early exaggeration iterations
+# separately, so 750 there means 1000 in total
+TSNE_N_ITER = {"cuml": 1000, "opentsne": 750, "sklearn": 750}
+
+# Optional t-SNE backends: cuML on the GPU, then openTSNE on all CPU cores, then scikit-learn
+try:
+    from cuml.manifold import TSNE as CumlTSNE
+except ImportError:
+    CumlTSNE = None
+
+try:
+    from openTSNE import TSNE as OpenTSNE
+except ImportError:
+    OpenTSNE = None
+
+# Title keywords per category, in priority order: a title matching several categories gets the first
+CATEGORY_KEYWORDS = {
+    'Predators': ['fox', 'wolf', 'lion', 'bear', 'tiger'],
+    'Prey Animals': ['hare', 'rabbit', 'mouse', 'deer', 'lamb'],
+    'Domestic Animals': ['dog', 'cat', 'horse', 'ass', 'donkey'],
+    'Birds': ['crow', 'eagle', 'owl', 'peacock', 'swan', 'nightingale'],
+    'Human Stories': ['man', 'woman', 'boy', 'girl', 'farmer', 'king', 'merchant'],
+    'Nature': ['sun', 'wind', 'tree', 'mountain', 'river'],
+}
+
+@lru_cache(maxsize=1)
+def get_chroma_client(db_path: str = "./chroma_db"):
+    """Open the persistent ChromaDB client once per process and reuse it."""
+    return chromadb.PersistentClient(path=db_path)
+
+def extract_embeddings_from_chromadb(db_path: str = "./chroma_db", page_size: int = 10_000) -> Tuple[np.ndarray, List[dict]]:
     """Extract all embeddings and metadata from ChromaDB."""
     print("Connecting to ChromaDB...")
-    client = chromadb.PersistentClient(path=db_path)
-    collection = client.get_collection("aesop_fables")
+    collection = get_chroma_client(db_path).get_collection("aesop_fables")
     
     print("Extracting embeddings...")
-    # Get all documents
-    results = collection.get(include=['embeddings', 'metadatas', 'documents'])
+    # count() also loads the collection's segments, so the bulk reads below start warm
+    count = collection.count()
+    embeddings = None
+    combined_data = []
     
-    embeddings = np.array(results['embeddings'])
-    metadatas = results['metadatas']
-    documents = results['documents']
+    # Page through the collection into one preallocated float32 array rather than a single huge get()
+    for offset in range(0, count, page_size):
+        results = collection.get(include=['embeddings', 'metadatas', 'documents'], limit=page_size, offset=offset)
+        page = np.asarray(results['embeddings'], dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.empty((count, page.shape[1]), dtype=np.float32)
+        embeddings[offset:offset + len(page)] = page
+        
+        # Combine metadata with documents for easier handling
+        for metadata, doc in zip(results['metadatas'], results['documents']):
+            combined_data.append({
+                **metadata,
+                'document': doc,
+                'id': len(combined_data)
+            })
     
     print(f"Extracted {len(embeddings)} embeddings of dimension {embeddings.shape[1]}")
     
-    # Combine metadata with documents for easier handling
-    combined_data = []
-    for i, (metadata, doc) in enumerate(zip(metadatas, documents)):
-        combined_data.append({
-            **metadata,
-            'document': doc,
-            'id': i
-        })
-    
     return embeddings, combined_data
 
-def categorize_fables(metadatas: List[dict]) -> List[str]:
+def categorize_fables(metadatas: List[dict]) -> np.ndarray:
     """Simple categorization of fables based on title keywords."""
-    categories = []
+    titles = np.char.lower(np.asarray([m['title'] for m in metadatas], dtype=str))
     
-    for metadata in metadatas:
-        title = metadata['title'].lower()
-        
-        # Simple keyword-based categorization
-        if any(animal in title for animal in ['fox', 'wolf', 'lion', 'bear', 'tiger']):
-            category = 'Predators'
-        elif any(animal in title for animal in ['hare', 'rabbit', 'mouse', 'deer', 'lamb']):
-            category = 'Prey Animals'
-        elif any(animal in title for animal in ['dog', 'cat', 'horse', 'ass', 'donkey']):
-            category = 'Domestic Animals'
-        elif any(bird in title for bird in ['crow', 'eagle', 'owl', 'peacock', 'swan', 'nightingale']):
-            category = 'Birds'
-        elif any(word in title for word in ['man', 'woman', 'boy', 'girl', 'farmer', 'king', 'merchant']):
-            category = 'Human Stories'
-        elif any(word in title for word in ['sun', 'wind', 'tree', 'mountain', 'river']):
-            category = 'Nature'
-        else:
-            category = 'Other'
-        
-        categories.append(category)
+    # One vectorized substring search per keyword, OR-ed into a mask per category
+    masks = [np.logical_or.reduce([np.char.find(titles, keyword) >= 0 for keyword in keywords])
+             for keywords in CATEGORY_KEYWORDS.values()]
+    
+    # np.select takes the first matching category, preserving keyword priority
+    return np.select(masks, list(CATEGORY_KEYWORDS), default='Other')
+
+def resolve_tsne_backend(backend: str = "auto") -> str:
+    """Map "auto" to the fastest installed t-SNE backend and validate explicit choices."""
+    if backend == "auto":
+        return "cuml" if CumlTSNE is not None else "opentsne" if OpenTSNE is not None else "sklearn"
+    if backend not in ("cuml", "opentsne", "sklearn"):
+        raise ValueError(f"Unknown t-SNE backend: {backend}")
+    return backend
+
+def reduce_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Prepare embeddings for t-SNE: contiguous float32, reduced to the leading principal components."""
+    # Contiguous float32 is required by cuML and avoids sklearn's internal upcast/copy
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
     
-    return categories
+    # Neighborhoods survive the reduction, while distance costs shrink with D
+    if embeddings.shape[1] > PCA_COMPONENTS:
+        n_components = min(PCA_COMPONENTS, len(embeddings))
+        embeddings = np.ascontiguousarray(PCA(n_components=n_components, random_state=42).fit_transform(embeddings))
+    return embeddings
 
-def create_tsne_visualization(embeddings: np.ndarray, metadatas: List[dict], output_file: str = "fables_tsne.html"):
-    """Create t-SNE visualization of the embeddings."""
+def fit_tsne(embeddings: np.ndarray, perplexity: int = 30, backend: str = "auto",
+             affinities=None, verbose: bool = False) -> np.ndarray:
+    """Project embeddings to 2-D with t-SNE using the fastest installed backend.
+    
+    embeddings should come from reduce_embeddings. backend is one of "auto", "cuml", "opentsne"
+    or "sklearn". affinities are optional precomputed openTSNE affinities (e.g. from a shared
+    kNN graph on the same reduced embeddings); other backends ignore them. verbose turns on
+    the backend's own progress output.
+    """
+    backend = resolve_tsne_backend(backend)
+    print(f"Using {backend} t-SNE backend")
+    
+    if backend == "cuml":
+        tsne = CumlTSNE(n_components=2, random_state=42, perplexity=perplexity, n_iter=TSNE_N_ITER[backend],
+                        method='barnes_hut', early_exaggeration=12, learning_rate=200, verbose=verbose)
+    elif backend == "opentsne":
+        tsne = OpenTSNE(n_components=2, random_state=42, perplexity=perplexity, n_iter=TSNE_N_ITER[backend],
+                        negative_gradient_method='fft', n_jobs=-1, verbose=verbose)
+        return np.asarray(tsne.fit(embeddings, affinities=affinities))
+    else:
+        tsne = TSNE(n_components=2, random_state=42, perplexity=perplexity, max_iter=TSNE_N_ITER[backend],
+                    method='barnes_hut', angle=0.5, init='pca', early_exaggeration=12,
+                    learning_rate='auto', n_jobs=-1, verbose=int(verbose))
+    
+    return np.asarray(tsne.fit_transform(embeddings))
+
+def tsne_cache_key(embeddings: np.ndarray, backend: str = "auto", *settings) -> str:
+    """Hash embedding values with the resolved backend, its settings and any caller-specific settings."""
+    # Key on the backend that will actually run, so "auto" results don't outlive a backend install
+    backend = resolve_tsne_backend(backend)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    digest = hashlib.blake2b(embeddings.tobytes(), digest_size=16)
+    digest.update(f"{embeddings.shape}|{backend}|pca{PCA_COMPONENTS}|iter{TSNE_N_ITER[backend]}".encode())
+    digest.update("|".join(map(str, settings)).encode())
+    return digest.hexdigest()
+
+def load_or_fit_tsne(embeddings: np.ndarray, perplexity: int = 30, backend: str = "auto",
+                     force: bool = False) -> np.ndarray:
+    """Return t-SNE coordinates cached on disk for identical embeddings and settings, fitting on a miss."""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    cache_path = TSNE_CACHE_DIR / f"{tsne_cache_key(embeddings, backend, perplexity)}.npy"
+    
+    if cache_path.exists() and not force:
+        print(f"Loaded cached t-SNE result from {cache_path}")
+        return np.load(cache_path)
+    
+    embeddings_2d = fit_tsne(reduce_embeddings(embeddings), perplexity, backend)
+    TSNE_CACHE_DIR.mkdir(exist_ok=True)
+    np.save(cache_path, embeddings_2d)
+    return embeddings_2d
+
+def create_tsne_visualization(embeddings: np.ndarray, metadatas: List[dict], output_file: str = "fables_tsne.html",
+                              backend: str = "auto", force: bool = False):
+    """Create t-SNE visualization of the embeddings, reusing a cached projection unless force is set."""
     print("Running t-SNE dimensionality reduction...")
     
-    # Run t-SNE
-    tsne = TSNE(n_components=2, random_state=42, perplexity=30, n_iter=1000)
-    embeddings_2d = tsne.fit_transform(embeddings)
+    embeddings_2d = load_or_fit_tsne(embeddings, backend=backend, force=force)
     
     print("Creating visualization...")
     
-    # Prepare data for plotting
+    # Prepare data for plotting, gathering every hover column in a single pass over the metadata
     categories = categorize_fables(metadatas)
-    word_counts = [m['word_count'] for m in metadatas]
-    titles = [m['title'] for m in metadatas]
+    titles = []
+    word_counts = []
+    previews = []
+    for title, word_count, document in map(itemgetter('title', 'word_count', 'document'), metadatas):
+        titles.append(title)
+        word_counts.append(word_count)
+        previews.append(document[:100] + '...' if len(document) > 100 else document)
     
-    # Create DataFrame
+    # Create DataFrame, used for the cluster analysis only
     df = pd.DataFrame({
         'x': embeddings_2d[:, 0],
         'y': embeddings_2d[:, 1],
         'title': titles,
         'word_count': word_counts,
-        'category': categories,
-        'preview': [m['document'][:100] + '...' if len(m['document']) > 100 else m['document'] 
-                   for m in metadatas]
+        # Categorical keeps one small-int code per fable; categories stay in first-seen order for the legend
+        'category': pd.Categorical(categories, categories=pd.unique(categories)),
+        'preview': previews
     })
     
-    # Create interactive scatter plot
-    fig = px.scatter(
-        df, 
-        x='x', 
-        y='y',
-        color='category',
-        hover_data={
-            'title': True,
-            'word_count': True,
-            'category': True,
-            'x': False,
-            'y': False
-        },
-        title='t-SNE Visualization of Aesop Fables (by Category)',
-        labels={'x': 't-SNE Dimension 1', 'y': 't-SNE Dimension 2'}
-    )
+    # Plot straight from NumPy arrays rather than converting the DataFrame for plotly
+    x = embeddings_2d[:, 0].astype(np.float32)
+    y = embeddings_2d[:, 1].astype(np.float32)
+    word_counts = np.asarray(word_counts)
+    customdata = np.stack([np.asarray(titles, dtype=object), word_counts.astype(object), categories.astype(object)], axis=1)
+    hovertemplate = ('<b>%{customdata[0]}</b><br>' +
+                     'Category: %{customdata[2]}<br>' +
+                     'Word Count: %{customdata[1]}<br>' +
+                     '<extra></extra>')
     
-    # Customize hover template
-    fig.update_traces(
-        hovertemplate='<b>%{customdata[0]}</b><br>' +
-                      'Category: %{customdata[2]}<br>' +
-                      'Word Count: %{customdata[1]}<br>' +
-                      '<extra></extra>',
-        customdata=df[['title', 'word_count', 'category']].values
-    )
+    category_title = 't-SNE Visualization of Aesop Fables (by Category)'
+    wordcount_title = 't-SNE Visualization of Aesop Fables (by Word Count)'
     
-    # Update layout
+    # One trace per category for the legend, then a single hidden trace coloured by word count
+    fig = go.Figure()
+    category_names = pd.unique(categories).tolist()
+    for category in category_names:
+        mask = categories == category
+        fig.add_trace(go.Scattergl(
+            x=x[mask],
+            y=y[mask],
+            mode='markers',
+            name=category,
+            customdata=customdata[mask],
+            hovertemplate=hovertemplate
+        ))
+    fig.add_trace(go.Scattergl(
+        x=x,
+        y=y,
+        mode='markers',
+        name='word_count',
+        visible=False,
+        showlegend=False,
+        marker=dict(color=word_counts, coloraxis='coloraxis'),
+        customdata=customdata,
+        hovertemplate=hovertemplate
+    ))
+    
+    # Update layout, with a dropdown switching between the two colourings
+    n_category = len(category_names)
     fig.update_layout(
+        title_text=category_title,
+        xaxis_title='t-SNE Dimension 1',
+        yaxis_title='t-SNE Dimension 2',
         width=1200,
         height=800,
         showlegend=True,
         legend=dict(
+            title_text='category',
             yanchor="top",
             y=0.99,
             xanchor="left",
             x=0.01
-        )
+        ),
+        coloraxis=dict(colorscale='viridis', colorbar_title_text='word_count', showscale=False),
+        updatemenus=[dict(
+            buttons=[
+                dict(label='By Category', method='update',
+                     args=[{'visible': [True] * n_category + [False]},
+                           {'title.text': category_title, 'showlegend': True, 'coloraxis.showscale': False}]),
+                dict(label='By Word Count', method='update',
+                     args=[{'visible': [False] * n_category + [True]},
+                           {'title.text': wordcount_title, 'showlegend': False, 'coloraxis.showscale': True}])
+            ],
+            direction='down',
+            x=1.0,
+            xanchor='right',
+            y=1.08,
+            yanchor='bottom'
+        )]
     )
     
     # Save as HTML file
-    fig.write_html(output_file)
+    fig.write_html(output_file, include_plotlyjs='cdn', validate=False)
     print(f"Saved interactive t-SNE visualization to {output_file}")
     
-    # Also create a word count version
-    fig_wordcount = px.scatter(
-        df,
-        x='x',
-        y='y',
-        color='word_count',
-        hover_data={
-            'title': True,
-            'word_count': True,
-            'category': True,
-            'x': False,
-            'y': False
-        },
-        title='t-SNE Visualization of Aesop Fables (by Word Count)',
-        labels={'x': 't-SNE Dimension 1', 'y': 't-SNE Dimension 2'},
-        color_continuous_scale='viridis'
-    )
-    
-    fig_wordcount.update_traces(
-        hovertemplate='<b>%{customdata[0]}</b><br>' +
-                      'Category: %{customdata[2]}<br>' +
-                      'Word Count: %{customdata[1]}<br>' +
-                      '<extra></extra>',
-        customdata=df[['title', 'word_count', 'category']].values
-    )
-    
-    fig_wordcount.update_layout(width=1200, height=800)
-    fig_wordcount.write_html(output_file.replace('.html', '_wordcount.html'))
-    print(f"Saved word count version to {output_file.replace('.html', '_wordcount.html')}")
-    
     return df, fig
 
 def print_cluster_analysis(df: pd.DataFrame):
     """Print some basic analysis of the clusters."""
     print("\n=== Cluster Analysis ===")
     
+    # One grouping pass serves every per-category statistic below
+    grouped = df.groupby('category', observed=True, sort=False)
+    stats = grouped['word_count'].agg(fables='size', avg_words='mean').sort_values('fables', ascending=False, kind='stable')
+    
     # Category distribution
     print("\nCategory Distribution:")
-    category_counts = df['category'].value_counts()
-    for category, count in category_counts.items():
-        print(f"  {category}: {count} fables")
+    for row in stats.itertuples():
+        print(f"  {row.Index}: {row.fables} fables")
     
     # Word count statistics by category
     print("\nAverage Word Count by Category:")
-    for category in df['category'].unique():
-        avg_words = df[df['category'] == category]['word_count'].mean()
-        print(f"  {category}: {avg_words:.0f} words")
+    for row in stats.itertuples():
+        print(f"  {row.Index}: {row.avg_words:.0f} words")
     
     # Find some interesting clusters manually
     print("\nSample of fables by category:")
-    for category in df['category'].unique()[:3]:  # Show first 3 categories
-        sample_titles = df[df['category'] == category]['title'].head(3).tolist()
+    for category, group in islice(grouped, 3):  # Show first 3 categories
+        sample_titles = group['title'].head(3).tolist()
         print(f"  {category}: {', '.join(sample_titles)}")
 
 def main():
@@ -201,7 +306,7 @@ def main():
     
     print(f"\nOpen 'fables_tsne.html' in your browser to view the interactive visualization!")
     print("Each point represents a fable. Similar fables should cluster together.")
-    print("Hover over points to see fable details.")
+    print("Hover over points to see fable details, and use the dropdown to color by category or word count.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file